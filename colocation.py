@@ -0,0 +1,218 @@
+# Compare the diabetic retinopathy and vessel heatmaps created by
+# create_heatmap.py. Both sets of CSV files share the same nerve/macula frame,
+# so each pixel location can be compared directly.
+
+import csv
+import cv2
+import numpy as np
+import os
+import sys
+
+from create_heatmap import SIDE_LABELS, LESION_LABELS, VESSEL_LABELS, \
+                           NERVE_MAC_DIST, SIZE_MULTIPLIER
+
+# a pixel is counted as a vessel location if at least this many images have a
+# vessel there. The same threshold is used for every vessel type, and the
+# combined (ALL_AV) locations are the arteriole and venule locations together.
+VESSEL_MASK_MIN_COUNT = 1
+
+# distance histogram bins (measured in pixels). Distances past the last bin
+# are counted in the last bin.
+DISTANCE_BIN_WIDTH = max(1, int(5 * SIZE_MULTIPLIER))
+DISTANCE_BIN_COUNT = int(NERVE_MAC_DIST / DISTANCE_BIN_WIDTH) + 1
+
+def printUsage():
+    print("Usage: " + sys.argv[0] + " <dr_heatmap_dir> <vessels_heatmap_dir> [<outdir=colocation> [<dr_suffix> [<vessels_suffix>]]]")
+
+# Load the lesion count CSV files for each label and side.
+# Returns the labels that were found, and the data stored as
+# [side][label][pixel] (each heatmap is flattened).
+def loadHeatmaps(heatmap_dir, labels, suffix):
+    found = []
+    data = []
+    for l in labels:
+        paths = [os.path.join(heatmap_dir, "lesion_count_" + SIDE_LABELS[side] + "_" + l + suffix + ".csv") for side in SIDE_LABELS]
+        missing = [p for p in paths if not os.path.exists(p)]
+        if missing:
+            print("ERROR: heatmap file does not exist (ignoring " + l + "): " + missing[0])
+            continue
+
+        found.append(l)
+        data.append([np.loadtxt(p, delimiter=",", dtype=np.float64, ndmin=2) for p in paths])
+
+    if not found:
+        return found, None, None
+
+    shape = data[0][0].shape
+    data = np.array(data).reshape(len(found), len(SIDE_LABELS), -1)
+
+    return found, np.ascontiguousarray(data.transpose(1, 0, 2)), shape
+
+# Pearson correlation between each lesion type and each vessel type.
+# Returns a [lesion][vessel] array (nan if either heatmap is constant).
+def correlation(lesions, vessels):
+    lesions = lesions - lesions.mean(axis=1, keepdims=True)
+    vessels = vessels - vessels.mean(axis=1, keepdims=True)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lesions = lesions / np.linalg.norm(lesions, axis=1, keepdims=True)
+        vessels = vessels / np.linalg.norm(vessels, axis=1, keepdims=True)
+
+    return lesions @ vessels.T
+
+# Overlap between the lesion locations (any lesions found) and the vessel
+# locations (see VESSEL_MASK_MIN_COUNT).
+# Returns the overlap (Szymkiewicz-Simpson) coefficient and the Dice
+# coefficient as [lesion][vessel] arrays.
+def maskOverlap(lesion_mask, vessel_mask):
+    lesion_mask = lesion_mask.astype(np.float32)
+    vessel_mask = vessel_mask.astype(np.float32)
+
+    intersection = lesion_mask @ vessel_mask.T
+    lesion_area = lesion_mask.sum(axis=1)[:, np.newaxis]
+    vessel_area = vessel_mask.sum(axis=1)[np.newaxis, :]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        overlap = intersection / np.minimum(lesion_area, vessel_area)
+        dice = 2.0 * intersection / (lesion_area + vessel_area)
+
+    return overlap, dice
+
+# Overlap between the lesion and vessel densities (each heatmap scaled to sum
+# to one). Returns a [lesion][vessel] array.
+def densityOverlap(lesions, vessels):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lesions = lesions / lesions.sum(axis=1, keepdims=True)
+        vessels = vessels / vessels.sum(axis=1, keepdims=True)
+
+    overlap = np.zeros((len(lesions), len(vessels)))
+    for v in range(len(vessels)):
+        overlap[:, v] = np.minimum(lesions, vessels[v]).sum(axis=1)
+
+    return overlap
+
+# Distance (in pixels) from each pixel to the nearest vessel location.
+def vesselDistance(vessel_mask, shape):
+    not_vessel = np.where(vessel_mask.reshape(shape), 0, 1).astype(np.uint8)
+    return cv2.distanceTransform(not_vessel, cv2.DIST_L2, cv2.DIST_MASK_PRECISE).ravel()
+
+# Histogram of the distance from each lesion to the nearest vessel location,
+# weighted by lesion count. Returns a [lesion][bin] array.
+def distanceHistogram(lesions, distance):
+    bins = np.minimum((distance / DISTANCE_BIN_WIDTH).astype(np.intp), DISTANCE_BIN_COUNT - 1)
+
+    # give each lesion type its own set of bins so they can be counted at once
+    index = np.arange(len(lesions))[:, np.newaxis] * DISTANCE_BIN_COUNT + bins
+    counts = np.bincount(index.ravel(), weights=lesions.ravel(),
+                         minlength=len(lesions) * DISTANCE_BIN_COUNT)
+
+    return counts.reshape(len(lesions), DISTANCE_BIN_COUNT)
+
+def distanceBinNames():
+    names = []
+    for b in range(DISTANCE_BIN_COUNT - 1):
+        names.append(str(b * DISTANCE_BIN_WIDTH) + "-" + str((b + 1) * DISTANCE_BIN_WIDTH))
+    names.append(">=" + str((DISTANCE_BIN_COUNT - 1) * DISTANCE_BIN_WIDTH))
+    return names
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [3,4,5,6]:
+        printUsage()
+        sys.exit(1)
+
+    cli_args_valid = True
+
+    dr_dir = sys.argv[1]
+    if not os.path.isdir(dr_dir):
+        print("ERROR: dr_heatmap_dir does not exist: " + dr_dir)
+        cli_args_valid = False
+
+    vessels_dir = sys.argv[2]
+    if not os.path.isdir(vessels_dir):
+        print("ERROR: vessels_heatmap_dir does not exist: " + vessels_dir)
+        cli_args_valid = False
+
+    if not cli_args_valid:
+        printUsage()
+        sys.exit(1)
+
+    outdir = "colocation"
+    if len(sys.argv) > 3:
+        outdir = sys.argv[3]
+    os.makedirs(outdir, exist_ok=True)
+
+    dr_suffix = ""
+    if len(sys.argv) > 4:
+        dr_suffix = "_" + sys.argv[4]
+
+    vessels_suffix = ""
+    if len(sys.argv) > 5:
+        vessels_suffix = "_" + sys.argv[5]
+
+    print("Loading dr heatmaps...", end='', flush=True)
+    lesion_labels, lesion_data, lesion_shape = loadHeatmaps(dr_dir, LESION_LABELS, dr_suffix)
+    print("done")
+
+    print("Loading vessel heatmaps...", end='', flush=True)
+    vessel_labels, vessel_data, vessel_shape = loadHeatmaps(vessels_dir, VESSEL_LABELS, vessels_suffix)
+    print("done")
+
+    if lesion_data is None or vessel_data is None:
+        print("ERROR: no heatmaps to compare")
+        sys.exit(1)
+
+    if lesion_shape != vessel_shape:
+        print("ERROR: dr and vessel heatmaps are different sizes: " + str(lesion_shape) + " and " + str(vessel_shape))
+        sys.exit(1)
+
+    stats_rows = []
+    for side in SIDE_LABELS:
+        print("Comparing", SIDE_LABELS[side], "heatmaps...", end='', flush=True)
+        lesions = lesion_data[side]
+        vessels = vessel_data[side]
+
+        lesion_mask = lesions > 0
+        vessel_mask = vessels >= VESSEL_MASK_MIN_COUNT
+        if all(v in vessel_labels for v in ("A", "V", "ALL_AV")):
+            vessel_mask[vessel_labels.index("ALL_AV")] = vessel_mask[vessel_labels.index("A")] | vessel_mask[vessel_labels.index("V")]
+
+        corr = correlation(lesions, vessels)
+        overlap, dice = maskOverlap(lesion_mask, vessel_mask)
+        density_overlap = densityOverlap(lesions, vessels)
+
+        lesion_totals = lesions.sum(axis=1)
+        for v, vessel in enumerate(vessel_labels):
+            distance = vesselDistance(vessel_mask[v], vessel_shape)
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                mean_distance = (lesions @ distance) / lesion_totals
+
+            # no vessels, so there is no distance to measure
+            if not vessel_mask[v].any():
+                mean_distance[:] = np.nan
+
+            histogram = distanceHistogram(lesions, distance)
+            with open(os.path.join(outdir, "distance_" + SIDE_LABELS[side] + "_" + vessel + dr_suffix + vessels_suffix + ".csv"), "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["lesion"] + distanceBinNames())
+                for i, l in enumerate(lesion_labels):
+                    writer.writerow([l] + ["%g" % c for c in histogram[i]])
+
+            for i, l in enumerate(lesion_labels):
+                stats_rows.append([SIDE_LABELS[side], l, vessel,
+                                   "%.6f" % corr[i][v],
+                                   "%.6f" % overlap[i][v],
+                                   "%.6f" % dice[i][v],
+                                   "%.6f" % density_overlap[i][v],
+                                   "%.3f" % mean_distance[i]])
+        print("done")
+
+    with open(os.path.join(outdir, "colocation" + dr_suffix + vessels_suffix + ".csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["side", "lesion", "vessel", "correlation", "overlap_coefficient",
+                         "dice", "density_overlap", "mean_distance"])
+        writer.writerows(stats_rows)
+
+    print("Results written to \"" + outdir + "\"")
+
+# EOF
@@ -59,9 +59,23 @@ TRIM = [int(450 * SIZE_MULTIPLIER),
         int(450 * SIZE_MULTIPLIER),
         int(300 * SIZE_MULTIPLIER)]
 
+# accumulation modes. "pixels" counts every lesion pixel, "instances" counts
+# each connected lesion (instance) once at its centroid.
+PIXEL_MODE = "pixels"
+INSTANCE_MODE = "instances"
+MODES = (PIXEL_MODE, INSTANCE_MODE)
+
+# In instances mode, set to True to mark each lesion as a disc with the same
+# (scaled) area as the lesion rather than as a single pixel at its centroid.
+INSTANCE_AREA_KERNEL = False
+
 # directory structure for images
 IMAGE_SUBDIR = "image"
 LESION_SUBDIR = "label"
+
+# label files are named after the image, with one of these suffixes (.tif or
+# .png, depending on the source)
+LABEL_SUFFIXES = (".tif", ".png", "_AV.tif")
 LESION_LABELS = { "EX": "Exudates",\
                   "HE": "Haemorrhages",\
                   "MA": "Microaneurysms",\
@@ -99,6 +113,13 @@ class CoordsData:
                ", nerve_xy=(" + str(self.nerve_xy) + ")" + \
                ", mac_xy=(" + str(self.mac_xy) + ")]"
 
+# Convert one row of the coordinates CSV file to a CoordsData object.
+# Raises ValueError or IndexError if the row is malformed.
+def parseCoordsRow(row, image_dir):
+    return CoordsData(os.path.join(image_dir, IMAGE_SUBDIR, row[0]),
+                      (int(row[1]), int(row[2])),
+                      (int(row[3]), int(row[4])))
+
 def parseCoordsFile(filename, image_dir):
     coords = list()
 
@@ -109,9 +130,7 @@ def parseCoordsFile(filename, image_dir):
             if (index == 0):
                 continue
 
-            coords.append(CoordsData(os.path.join(image_dir, IMAGE_SUBDIR, row[0]),
-                          (int(row[1]), int(row[2])),
-                          (int(row[3]), int(row[4]))))
+            coords.append(parseCoordsRow(row, image_dir))
 
     return coords
 
@@ -140,7 +159,23 @@ def trimImageArrays(image, labels, scale_lesion_counts=False):
     return trimmed
 
 def printUsage():
-    print("Usage: " + sys.argv[0] + " <coordinates_csv> <image_dir> <data_type (dr,vessels)> [<outdir=heatmaps> [<outfile_suffix>]]")
+    print("Usage: " + sys.argv[0] + " [--mode (pixels,instances)] [--smooth <bandwidth>[,<bandwidth>...]] <coordinates_csv> <image_dir> <data_type (dr,vessels)> [<outdir=heatmaps> [<outfile_suffix>]]")
+
+# Remove an optional "--name value" pair from argv and return the value, or
+# the default if the option was not given. Returns None if the option is
+# missing its value.
+def popOption(argv, name, default):
+    if name not in argv:
+        return default
+
+    pos = argv.index(name)
+    if pos + 1 >= len(argv):
+        del argv[pos]
+        return None
+
+    value = argv[pos + 1]
+    del argv[pos:pos + 2]
+    return value
 
 def addText(image, position, text):
     cv2.putText(image, text, position, cv2.FONT_HERSHEY_DUPLEX, 1, (255,255,255), 2)
@@ -159,7 +194,7 @@ def scaleImage(image_data):
 
     if (orig_dist == 0):
         print("ERROR: invalid tagging for image (ignoring): " + image_data.filename)
-        return None, None
+        return None, None, None
 
     # Calculate the angle from the nerve to the mac
     angle = math.degrees(math.atan(float(y) / float(x)))
@@ -184,13 +219,340 @@ def rightOrLeft(image_data):
         return RIGHT_EYE
     return LEFT_EYE
 
+# Find the label file for an image. Label files can have a few different
+# naming conventions and formats, so try them all.
+# Returns None if no label file exists.
+def findLabelFile(image_dir, lesion, image_filename):
+    lesion_image_path = os.path.join(image_dir, LESION_SUBDIR, lesion, os.path.split(image_filename)[1])
+
+    for suffix in LABEL_SUFFIXES:
+        label_path = os.path.splitext(lesion_image_path)[0] + suffix
+
+        if os.path.exists(label_path):
+            return label_path
+
+    return None
+
+# Load a label image, converted to binary (for ease of processing).
+# Returns None if the image can't be read.
+def loadLabel(lesion_image_path):
+    lesion_orig = cv2.imread(lesion_image_path, 0)
+    if lesion_orig is None:
+        return None
+    return np.where(lesion_orig > 0, 1, 0).astype(np.uint8)
+
+# Scale and rotate a binary label image so the nerve and macula line up with
+# every other image.
+def warpLabel(lesion_orig, nerve_xy_scaled, scaling_factor, rotation):
+    # scale it...
+    lesion_scaled = cv2.resize(lesion_orig, None,
+                               fx=scaling_factor,
+                               fy=scaling_factor)
+
+    # ...and rotate it
+    rot_matrix = cv2.getRotationMatrix2D(nerve_xy_scaled, rotation, 1.0)
+    img_dims = (len(lesion_scaled[0]), len(lesion_scaled))
+    return cv2.warpAffine(lesion_scaled, rot_matrix, img_dims)
+
+# Find each separate lesion (connected component) in a binary label image.
+# Returns the (x,y) centroid and the area (in pixels) of each lesion.
+def labelInstances(lesion_orig):
+    count, _, stats, centroids = cv2.connectedComponentsWithStats(lesion_orig, connectivity=8)
+
+    # component 0 is the background
+    return centroids[1:count], stats[1:count, cv2.CC_STAT_AREA]
+
+# Apply the same scale and rotation as warpLabel to a list of (x,y) points
+# in the original image. Returns the points in the scaled image.
+def transformPoints(points, nerve_xy_scaled, scaling_factor, rotation):
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+    # cv2.resize maps pixel centres, not pixel corners
+    scaled = (points + 0.5) * scaling_factor - 0.5
+
+    rot_matrix = cv2.getRotationMatrix2D(nerve_xy_scaled, rotation, 1.0)
+    return scaled @ rot_matrix[:, :2].T + rot_matrix[:, 2]
+
+# Canvas (row, col) coordinates of each pixel to mark for a set of lesions.
+# Lesions are a single pixel, or a disc if a radius is given.
+def instanceFootprint(rows, cols, radii):
+    if not np.any(radii):
+        return rows, cols
+
+    all_rows = []
+    all_cols = []
+    for row, col, radius in zip(rows, cols, radii):
+        dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+        inside = (dy * dy + dx * dx) <= radius * radius
+        all_rows.append(row + dy[inside])
+        all_cols.append(col + dx[inside])
+
+    return np.concatenate(all_rows), np.concatenate(all_cols)
+
+# Flat canvas index of each pixel a warped label image adds to the heatmap
+# (repeated if a pixel is counted more than once).
+# Returns None if the label maps outside of the canvas.
+def labelPixelMarks(lesion_scaled, nerve_xy_scaled, canvas_shape):
+    y_from = NERVE_COORD - nerve_xy_scaled[1]
+    x_from = NERVE_COORD - nerve_xy_scaled[0]
+
+    if (x_from < 0 or y_from < 0 or x_from + len(lesion_scaled[0]) > canvas_shape[1] or y_from + len(lesion_scaled) > canvas_shape[0]):
+        return None
+
+    rows, cols = np.nonzero(lesion_scaled)
+    marks = (rows + y_from) * canvas_shape[1] + (cols + x_from)
+    return np.repeat(marks, lesion_scaled[rows, cols])
+
+# Flat canvas index of each pixel marked for the lesion instances in a label
+# image (repeated if a pixel is marked more than once).
+# Returns the marks and the number of lesions which mapped outside of the
+# canvas (these are not marked).
+def labelInstanceMarks(centroids, areas, nerve_xy_scaled, scaling_factor, rotation, canvas_shape):
+    points = transformPoints(centroids, nerve_xy_scaled, scaling_factor, rotation)
+
+    rows = np.rint(points[:, 1]).astype(np.intp) + NERVE_COORD - nerve_xy_scaled[1]
+    cols = np.rint(points[:, 0]).astype(np.intp) + NERVE_COORD - nerve_xy_scaled[0]
+
+    # ignore any lesions that fall off the canvas
+    canvas_rows, canvas_cols = canvas_shape
+    valid = (rows >= 0) & (rows < canvas_rows) & (cols >= 0) & (cols < canvas_cols)
+    rows = rows[valid]
+    cols = cols[valid]
+
+    radii = np.zeros(len(rows), dtype=np.intp)
+    if INSTANCE_AREA_KERNEL:
+        scaled_areas = np.asarray(areas, dtype=np.float64)[valid] * scaling_factor * scaling_factor
+        radii = np.rint(np.sqrt(scaled_areas / math.pi)).astype(np.intp)
+
+    mark_rows, mark_cols = instanceFootprint(rows, cols, radii)
+    inside = (mark_rows >= 0) & (mark_rows < canvas_rows) & (mark_cols >= 0) & (mark_cols < canvas_cols)
+
+    return mark_rows[inside] * canvas_cols + mark_cols[inside], len(valid) - len(rows)
+
+# Add (or remove) marks from labelPixelMarks or labelInstanceMarks to the
+# heatmap, including the composite label and the combined (both eyes)
+# heatmaps.
+def addMarks(heatmap_data, side, index, composite_label, marks, remove=False):
+    # count repeated marks first, so each pixel is only updated once
+    marks, counts = np.unique(marks, return_counts=True)
+    counts = counts.astype(heatmap_data.dtype)
+
+    # composite heatmaps are represented as right side, so mirror left data
+    both_marks = marks
+    if (side == LEFT_EYE):
+        canvas_cols = heatmap_data.shape[-1]
+        rows, cols = np.divmod(marks, canvas_cols)
+        both_marks = rows * canvas_cols + (canvas_cols - 1) - cols
+
+    for target_side, target_marks in ((side, marks), (BOTH_EYES, both_marks)):
+        for target_index in (index, composite_label):
+            heatmap = heatmap_data[target_side][target_index].reshape(-1)
+            if remove:
+                heatmap[target_marks] -= counts
+            else:
+                heatmap[target_marks] += counts
+
+# Add each lesion instance to the heatmap, including the composite label and
+# the combined (both eyes) heatmaps.
+# Returns the number of lesions which mapped outside of the canvas (these are
+# not added).
+def addLabelInstances(heatmap_data, side, index, composite_label, centroids, areas, nerve_xy_scaled, scaling_factor, rotation):
+    marks, outside = labelInstanceMarks(centroids, areas, nerve_xy_scaled,
+                                        scaling_factor, rotation,
+                                        heatmap_data.shape[-2:])
+    addMarks(heatmap_data, side, index, composite_label, marks)
+
+    return outside
+
+# Render one lesion type from the heatmap data (stored as [side][lesion][x][y]
+# on the full canvas) as a normalised image for each side, with the nerve and
+# macula marked. Returns the trimmed right, left and combined images side by
+# side.
+def renderHeatmapStack(heatmap_data, index, label_name):
+    # We now have a giant array with count values. Convert to a uint8 array with
+    # normalised values.
+    heatmap_image = np.zeros((3, 1, NERVE_COORD * 2, NERVE_COORD * 2), dtype=np.uint8)
+    for side in [RIGHT_EYE, LEFT_EYE, BOTH_EYES]:
+        # normalise by the real maximum - smoothed data is usually less than one
+        heatmap_max = float(heatmap_data[side][index].max())
+        heatmap_scale = 255.0 / heatmap_max if heatmap_max > 0 else 0.0
+        heatmap_image[side][0] = heatmap_data[side][index] * heatmap_scale
+
+        # add the optic nerve visualisation
+        cv2.circle(heatmap_image[side][0], (NERVE_COORD, NERVE_COORD), int(45 * SIZE_MULTIPLIER), (255), 2)
+        cv2.circle(heatmap_image[side][0], (NERVE_COORD, NERVE_COORD), int(30 * SIZE_MULTIPLIER), (255), 2)
+        cv2.circle(heatmap_image[side][0], (NERVE_COORD, NERVE_COORD), int(15 * SIZE_MULTIPLIER), (255), 2)
+
+        # and the macula
+        mac_coord = (NERVE_COORD - ((1, -1, 1)[side] * NERVE_MAC_DIST),
+                    NERVE_COORD + MAC_DROP)
+        cv2.circle(heatmap_image[side][0],
+                   mac_coord,
+                   int(25 * SIZE_MULTIPLIER), (255), 2)
+
+        # also draw in the quads used for stats
+        if (DRAW_QUADS):
+            cv2.line(heatmap_image[side][0],
+                     (mac_coord[0] - QUAD_BOX_SIZE[0], mac_coord[1]),
+                     (mac_coord[0] + QUAD_BOX_SIZE[0], mac_coord[1]),
+                     255, 2)
+            cv2.line(heatmap_image[side][0],
+                     (mac_coord[0], mac_coord[1] - QUAD_BOX_SIZE[1]),
+                     (mac_coord[0], mac_coord[1] + QUAD_BOX_SIZE[1]),
+                     255, 2)
+            cv2.rectangle(heatmap_image[side][0],
+                          (mac_coord[0] - QUAD_BOX_SIZE[0], mac_coord[1] - QUAD_BOX_SIZE[1]),
+                          (mac_coord[0] + QUAD_BOX_SIZE[0], mac_coord[1] + QUAD_BOX_SIZE[1]),
+                          255, 2)
+
+    # trim the black edges from the images
+    trimmed = trimImageArrays(heatmap_image, [label_name])
+
+    # add some descriptive text
+    if ADD_LABELS:
+        addText(trimmed[RIGHT_EYE][0], (30,50), "Right Eye - " + label_name)
+        addText(trimmed[LEFT_EYE][0], (30,50), "Left Eye - " + label_name)
+        addText(trimmed[BOTH_EYES][0], (30,50), "Combined - " + label_name)
+
+    # and put them together
+    return np.hstack((trimmed[RIGHT_EYE][0],\
+                      trimmed[LEFT_EYE][0],\
+                      trimmed[BOTH_EYES][0])).astype(np.uint8)
+
+# Put the trimmed data (stored as [side][lesion][x][y]) for one lesion type
+# back on to an empty full canvas, stored as [side][0][x][y].
+def untrimLabel(trimmed, index):
+    canvas = np.zeros((len(trimmed), 1, NERVE_COORD * 2, NERVE_COORD * 2), dtype=trimmed.dtype)
+    for side in range(len(trimmed)):
+        row_from, row_to, col_from, col_to = trimRegion(side, NERVE_COORD * 2, NERVE_COORD * 2)
+        canvas[side][0][row_from:row_to, col_from:col_to] = trimmed[side][index]
+    return canvas
+
+# Render each lesion type from the heatmap data (stored as
+# [side][lesion][x][y] on the full canvas, or already trimmed if trimmed is
+# True) and write one PNG per lesion type to outdir. Returns the image stack
+# for each lesion type.
+def renderHeatmaps(heatmap_data, labels, outdir, out_suffix, trimmed=False):
+    stacks = []
+    for index, lesion in enumerate(labels):
+        print("Generating", labels[lesion], "heatmaps...", end='', flush=True)
+        if trimmed:
+            # one label at a time, so only one full canvas is needed
+            s = renderHeatmapStack(untrimLabel(heatmap_data, index), 0, labels[lesion])
+        else:
+            s = renderHeatmapStack(heatmap_data, index, labels[lesion])
+        print("done")
+        cv2.imwrite(os.path.join(outdir, "heatmap_" + lesion + out_suffix + ".png"), s)
+        stacks.append(s)
+
+    if BIG_STACK_IMAGE:
+        composite = None
+        for s in stacks:
+            if (composite is None):
+                composite = s
+            else:
+                composite = np.vstack((composite, s))
+        cv2.imwrite(os.path.join(outdir, "heatmap" + out_suffix + ".png"), composite.astype(np.uint8))
+
+    return stacks
+
+# Parse a smoothing bandwidth. This is a number of canvas pixels (e.g. "10")
+# or a fraction of NERVE_MAC_DIST (e.g. "0.1nm").
+# Returns the bandwidth in pixels, or None if it is invalid.
+def parseBandwidth(bandwidth):
+    scale = 1.0
+    if bandwidth.endswith("nm"):
+        scale = float(NERVE_MAC_DIST)
+        bandwidth = bandwidth[:-2]
+
+    try:
+        pixels = float(bandwidth) * scale
+    except ValueError:
+        return None
+
+    if pixels <= 0 or not math.isfinite(pixels):
+        return None
+
+    return pixels
+
+# The (row_from, row_to, col_from, col_to) region of the canvas kept by
+# trimImageArrays for each side.
+def trimRegion(side, canvas_rows, canvas_cols):
+    if side == LEFT_EYE:
+        return (TRIM[SUPERIOR], canvas_rows - TRIM[INFERIOR], TRIM[NASAL], canvas_cols - TRIM[TEMPORAL])
+    return (TRIM[SUPERIOR], canvas_rows - TRIM[INFERIOR], TRIM[TEMPORAL], canvas_cols - TRIM[NASAL])
+
+# Smooth heatmap data (stored as [side][lesion][x][y]) with a gaussian kernel,
+# where bandwidth is the standard deviation in pixels. Smoothing uses the FFT,
+# so large kernels take no longer than small ones. Only the trimmed region of
+# each side is smoothed (using the data up to 4 bandwidths around it).
+# Returns the trimmed regions only, as a float32 array stored as
+# [side][lesion][x][y] (the same layout as trimImageArrays).
+def smoothHeatmaps(heatmap_data, bandwidth):
+    canvas_rows, canvas_cols = heatmap_data.shape[-2:]
+    margin = int(math.ceil(4 * bandwidth))
+
+    row_from, row_to, col_from, col_to = trimRegion(RIGHT_EYE, canvas_rows, canvas_cols)
+    smoothed = np.zeros((len(heatmap_data), len(heatmap_data[0]), row_to - row_from, col_to - col_from), dtype=np.float32)
+    for side in range(len(heatmap_data)):
+        row_from, row_to, col_from, col_to = trimRegion(side, canvas_rows, canvas_cols)
+
+        # the data that can affect the trimmed region
+        crop_row_from = max(0, row_from - margin)
+        crop_row_to = min(canvas_rows, row_to + margin)
+        crop_col_from = max(0, col_from - margin)
+        crop_col_to = min(canvas_cols, col_to + margin)
+
+        # pad with zeros so data doesn't wrap around the edges of the canvas
+        fft_rows = cv2.getOptimalDFTSize(crop_row_to - crop_row_from + margin)
+        fft_cols = cv2.getOptimalDFTSize(crop_col_to - crop_col_from + margin)
+
+        # fourier transform of the gaussian kernel
+        freq_y = np.fft.fftfreq(fft_rows)[:, np.newaxis]
+        freq_x = np.fft.rfftfreq(fft_cols)[np.newaxis, :]
+        kernel = np.exp(-2.0 * (math.pi * bandwidth) ** 2 * (freq_y * freq_y + freq_x * freq_x)).astype(np.float32)
+
+        out_rows = slice(row_from - crop_row_from, row_to - crop_row_from)
+        out_cols = slice(col_from - crop_col_from, col_to - crop_col_from)
+        for index in range(len(heatmap_data[side])):
+            crop = heatmap_data[side][index][crop_row_from:crop_row_to, crop_col_from:crop_col_to]
+            spectrum = np.fft.rfft2(crop.astype(np.float32), s=(fft_rows, fft_cols))
+            spectrum *= kernel
+            smoothed[side][index] = np.fft.irfft2(spectrum, s=(fft_rows, fft_cols))[out_rows, out_cols]
+
+    # remove rounding noise around zero
+    np.maximum(smoothed, 0, out=smoothed)
+
+    return smoothed
+
 if __name__ == '__main__':
+    mode = popOption(sys.argv, "--mode", PIXEL_MODE)
+    smooth = popOption(sys.argv, "--smooth", "")
+
     if (len(sys.argv) not in [4,5,6]):
         printUsage()
         sys.exit(1)
 
     cli_args_valid = True
 
+    if mode not in MODES:
+        print("ERROR: mode must be 'pixels' or 'instances'")
+        cli_args_valid = False
+
+    # smoothing bandwidths, as (name, pixels)
+    bandwidths = []
+    if smooth is None:
+        print("ERROR: no smoothing bandwidths given")
+        cli_args_valid = False
+    elif smooth != "":
+        for bandwidth_name in smooth.split(","):
+            bandwidth = parseBandwidth(bandwidth_name)
+            if bandwidth is None:
+                print("ERROR: invalid smoothing bandwidth \"" + bandwidth_name + "\": must be a number of pixels or a fraction of the nerve-macula distance (e.g. 0.1nm)")
+                cli_args_valid = False
+            else:
+                bandwidths.append((bandwidth_name, bandwidth))
+
     coords_csv = os.path.abspath(sys.argv[1])
     if (not os.path.exists(coords_csv)):
         print("ERROR: coordinates_csv file \"" + coords_csv + "\" does not exist")
@@ -227,6 +589,7 @@ if __name__ == '__main__':
 
     print("Using CSV file \"" + coords_csv + "\"")
     print("with image dir \"" + image_dir + "\"")
+    print("counting lesion " + mode)
 
     coords_data = parseCoordsFile(coords_csv, image_dir)
 
@@ -261,61 +624,38 @@ if __name__ == '__main__':
             if index == composite_label:
                 continue
 
-            lesion_image_path = os.path.join(image_dir, LESION_SUBDIR, lesion, os.path.split(record.filename)[1])
+            lesion_image_path = findLabelFile(image_dir, lesion, record.filename)
 
-            # lesion files are .tif or .png, depending on the source
-            # label files can have a few different naming conventions and formats. Try them all.
-            path_valid = False
-            for suffix in (".tif", ".png", "_AV.tif"):
-                label_path = os.path.splitext(lesion_image_path)[0] + suffix
-
-                if os.path.exists(label_path):
-                    lesion_image_path = label_path
-                    path_valid = True
-                    break
-
-            if not path_valid:
+            if lesion_image_path is None:
                 # no valid file found
-                print("ERROR: label file does not exist (ignoring): " + os.path.split(lesion_image_path)[0])
+                print("ERROR: label file does not exist (ignoring): " + os.path.join(image_dir, LESION_SUBDIR, lesion))
                 continue
 
-            # load the image...
-            lesion_orig = cv2.imread(lesion_image_path, 0)
-
-            # ...convert to binary (for ease of processing)...
-            lesion_orig = np.where(lesion_orig > 0, 1, 0).astype(np.uint8)
-
-            # ...scale it...
-            lesion_scaled = cv2.resize(lesion_orig, None,
-                                       fx=scaling_factor,
-                                       fy=scaling_factor)
-
-            # ...rotate it...
-            rot_matrix = cv2.getRotationMatrix2D(nerve_xy_scaled, rotation, 1.0)
-            img_dims = (len(lesion_scaled[0]), len(lesion_scaled))
-            lesion_scaled = cv2.warpAffine(lesion_scaled, rot_matrix, img_dims)
-
-            # ...and mark it in our heatmap matrix
-            y_from = NERVE_COORD - nerve_xy_scaled[1]
-            y_to = y_from + len(lesion_scaled)
-            x_from = NERVE_COORD - nerve_xy_scaled[0]
-            x_to = x_from + len(lesion_scaled[0])
-
-            if (x_from < 0 or y_from < 0 or x_to > len(heatmap_data[side][index]) or y_to > len(heatmap_data[side][index][0])):
-                print("ERROR:", lesion, "mapping outside of bounds (ignoring):", os.path.basename(record.filename))
+            # load the image (as binary)...
+            lesion_orig = loadLabel(lesion_image_path)
+            if lesion_orig is None:
+                print("ERROR: label file can't be read (ignoring): " + lesion_image_path)
                 continue
 
-            heatmap_data[side][index][y_from:y_to, x_from:x_to] += lesion_scaled
-            heatmap_data[side][composite_label][y_from:y_to, x_from:x_to] += lesion_scaled
+            if mode == INSTANCE_MODE:
+                # ...find each lesion and mark its (scaled and rotated) centre.
+                # Only the centroids are transformed, not the whole image.
+                centroids, areas = labelInstances(lesion_orig)
+                outside = addLabelInstances(heatmap_data, side, index, composite_label,
+                                            centroids, areas, nerve_xy_scaled,
+                                            scaling_factor, rotation)
+                if outside > 0:
+                    print("ERROR:", outside, lesion, "lesion(s) mapping outside of bounds (ignoring):", os.path.basename(record.filename))
+            else:
+                # ...scale and rotate it...
+                lesion_scaled = warpLabel(lesion_orig, nerve_xy_scaled, scaling_factor, rotation)
 
-            # add data to our composite heatmaps as well - represented as right side,
-            # so need to mirror left data.
-            if (side == LEFT_EYE):
-                lesion_scaled = np.fliplr(lesion_scaled)
-                x_from = NERVE_COORD - len(lesion_scaled[0]) + nerve_xy_scaled[0]
-                x_to = x_from + len(lesion_scaled[0])
-            heatmap_data[BOTH_EYES][index][y_from:y_to, x_from:x_to] += lesion_scaled
-            heatmap_data[BOTH_EYES][composite_label][y_from:y_to, x_from:x_to] += lesion_scaled
+                # ...and mark it in our heatmap matrix
+                marks = labelPixelMarks(lesion_scaled, nerve_xy_scaled, heatmap_data.shape[-2:])
+                if marks is None:
+                    print("ERROR:", lesion, "mapping outside of bounds (ignoring):", os.path.basename(record.filename))
+                    continue
+                addMarks(heatmap_data, side, index, composite_label, marks)
 
             # if we are saving progress for each image, do that here
             if SAVE_INTERMEDIATE_DATA:
@@ -340,7 +680,10 @@ if __name__ == '__main__':
         print("How to interpret the CSV files", file=f)
         print("==============================", file=f)
         print("", file=f)
-        print("Each file contains the number of lesions found at each pixel co-ordinate.", file=f)
+        if mode == INSTANCE_MODE:
+            print("Each file contains the number of lesions centred at each pixel co-ordinate.", file=f)
+        else:
+            print("Each file contains the number of lesions found at each pixel co-ordinate.", file=f)
         print("Note that this uses the screen standard of (0, 0) located at the top left corner.", file=f)
         print("", file=f)
         print("For the right eye and composite images:", file=f)
@@ -351,71 +694,23 @@ if __name__ == '__main__':
         print("  Optic nerve position = (", NERVE_COORD - TRIM[NASAL], ",", NERVE_COORD - TRIM[SUPERIOR], ")", file=f)
         print("  Macular position = (", NERVE_COORD - TRIM[NASAL] + NERVE_MAC_DIST, ",", NERVE_COORD - TRIM[SUPERIOR] + MAC_DROP, ")", file=f)
 
-    # We now have a giant array with count values. Convert to a uint8 array with
-    # normalised values.
-    heatmap_image = np.zeros((3, len(labels) + 1, NERVE_COORD * 2, NERVE_COORD * 2), dtype=np.uint8)
-    for side in [RIGHT_EYE, LEFT_EYE, BOTH_EYES]:
-        for index, lesion in enumerate(labels):
-            print("Generating", ("right", "left", "composite")[side], labels[lesion], "heatmap...", end='')
-            heatmap_scale = 255.0 / float(max(1, heatmap_data[side][index].max()))
-            heatmap_image[side][index] = heatmap_data[side][index] * heatmap_scale
-
-            # add the optic nerve visualisation
-            cv2.circle(heatmap_image[side][index], (NERVE_COORD, NERVE_COORD), int(45 * SIZE_MULTIPLIER), (255), 2)
-            cv2.circle(heatmap_image[side][index], (NERVE_COORD, NERVE_COORD), int(30 * SIZE_MULTIPLIER), (255), 2)
-            cv2.circle(heatmap_image[side][index], (NERVE_COORD, NERVE_COORD), int(15 * SIZE_MULTIPLIER), (255), 2)
-
-            # and the macula
-            mac_coord = (NERVE_COORD - ((1, -1, 1)[side] * NERVE_MAC_DIST),
-                        NERVE_COORD + MAC_DROP)
-            cv2.circle(heatmap_image[side][index],
-                       mac_coord,
-                       int(25 * SIZE_MULTIPLIER), (255), 2)
-
-            # also draw in the quads used for stats
-            if (DRAW_QUADS):
-                cv2.line(heatmap_image[side][index],
-                         (mac_coord[0] - QUAD_BOX_SIZE[0], mac_coord[1]),
-                         (mac_coord[0] + QUAD_BOX_SIZE[0], mac_coord[1]),
-                         255, 2)
-                cv2.line(heatmap_image[side][index],
-                         (mac_coord[0], mac_coord[1] - QUAD_BOX_SIZE[1]),
-                         (mac_coord[0], mac_coord[1] + QUAD_BOX_SIZE[1]),
-                         255, 2)
-                cv2.rectangle(heatmap_image[side][index],
-                              (mac_coord[0] - QUAD_BOX_SIZE[0], mac_coord[1] - QUAD_BOX_SIZE[1]),
-                              (mac_coord[0] + QUAD_BOX_SIZE[0], mac_coord[1] + QUAD_BOX_SIZE[1]),
-                              255, 2)
-
-            print("done")
-
-    # trim the black edges from the images
-    trimmed = trimImageArrays(heatmap_image, labels)
+    # write the heatmap images
+    stacks = renderHeatmaps(heatmap_data, labels, outdir, out_suffix)
 
-    # add some descriptive text
-    if ADD_LABELS:
-        for i, l in enumerate(labels):
-            addText(trimmed[RIGHT_EYE][i], (30,50), "Right Eye - " + labels[l])
-            addText(trimmed[LEFT_EYE][i], (30,50), "Left Eye - " + labels[l])
-            addText(trimmed[BOTH_EYES][i], (30,50), "Combined - " + labels[l])
+    # and the smoothed versions, next to the raw data
+    for bandwidth_name, bandwidth in bandwidths:
+        print("Smoothing heatmaps with bandwidth", bandwidth_name, "(" + str(bandwidth) + " pixels)...", end='', flush=True)
+        smoothed = smoothHeatmaps(heatmap_data, bandwidth)
+        print("done")
 
-    # and we're done! put all the heatmaps together
-    stacks = []
-    for index, lesion in enumerate(labels):
-        s = np.hstack((trimmed[RIGHT_EYE][index],\
-                       trimmed[LEFT_EYE][index],\
-                       trimmed[BOTH_EYES][index]))
-        cv2.imwrite(os.path.join(outdir, "heatmap_" + lesion + out_suffix + ".png"), s.astype(np.uint8))
-        stacks.append(s)
+        # the smoothed data is already trimmed
+        smooth_suffix = out_suffix + "_smooth" + bandwidth_name
+        for side in [RIGHT_EYE, LEFT_EYE, BOTH_EYES]:
+            for i, l in enumerate(labels):
+                np.savetxt(os.path.join(outdir, "lesion_count_" + SIDE_LABELS[side] + "_" + l + smooth_suffix + ".csv"), smoothed[side][i], fmt="%.4f", delimiter=",")
 
-    if BIG_STACK_IMAGE:
-        composite = None
-        for s in stacks:
-            if (composite is None):
-                composite = s
-            else:
-                composite = np.vstack((composite, s))
-        cv2.imwrite(os.path.join(outdir, "heatmap" + out_suffix + ".png"), composite.astype(np.uint8))
+        renderHeatmaps(smoothed, labels, outdir, smooth_suffix, trimmed=True)
+        del smoothed
 
     if PREVIEW:
         # for display purposes, shrink down the image to fit on (most) screens
@@ -0,0 +1,511 @@
+# Serve up-to-date heatmaps while images are still being annotated.
+#
+# The dataset is loaded once and the heatmap data is kept in memory. The
+# coordinates CSV file and the label directories are watched for changes, and
+# only the images which have changed are recalculated. The current lesion
+# counts (CSV) and heatmaps (PNG) are served over HTTP on the local machine.
+
+import csv
+import cv2
+import http.server
+import io
+import json
+import numpy as np
+import os
+import sys
+import threading
+import time
+import urllib.parse
+
+from create_heatmap import SIDE_LABELS, LESION_LABELS, VESSEL_LABELS, \
+                           NERVE_COORD, LESION_SUBDIR, LABEL_SUFFIXES, \
+                           PIXEL_MODE, INSTANCE_MODE, MODES, \
+                           parseCoordsRow, trimImageArrays, popOption, \
+                           rightOrLeft, scaleImage, findLabelFile, loadLabel, \
+                           warpLabel, labelPixelMarks, labelInstances, \
+                           labelInstanceMarks, addMarks, renderHeatmapStack
+
+# how often (in seconds) to check the coordinates CSV file and label
+# directories for changes
+POLL_INTERVAL = 2.0
+
+# A label file that can't be read is probably still being written, so it is
+# retried until it has been unchanged for this long (in seconds). After that
+# it is ignored until it changes.
+LABEL_RETRY_TIME = 30.0
+
+DEFAULT_PORT = 8000
+
+def printUsage():
+    print("Usage: " + sys.argv[0] + " [--mode (pixels,instances)] [--port <port=" + str(DEFAULT_PORT) + ">] <coordinates_csv> <image_dir> <data_type (dr,vessels)>")
+
+# The image name (without extension) that a label file belongs to.
+def labelStem(label_filename):
+    # check the longest suffixes first, e.g. "_AV.tif" before ".tif"
+    for suffix in sorted(LABEL_SUFFIXES, key=len, reverse=True):
+        if label_filename.endswith(suffix):
+            return label_filename[:-len(suffix)]
+    return os.path.splitext(label_filename)[0]
+
+def imageStem(image_filename):
+    return os.path.splitext(os.path.basename(image_filename))[0]
+
+# Heatmap data for the whole dataset, kept up to date with the files on disk.
+# The contribution of each image to the heatmap is stored, so it can be
+# removed again when the image's coordinates or labels change.
+class HeatmapState:
+    coords_csv = None
+    image_dir = None
+    labels = None
+    mode = None
+    composite_label = None
+
+    # stored as [side][lesion][x][y], as in create_heatmap.py
+    heatmap_data = None
+
+    # image filename -> CoordsData
+    records = None
+
+    # image filename -> { label index: (side, marks) }
+    contributions = None
+
+    # (csv mtime, csv size), and label index -> { label filename: mtime }
+    coords_snapshot = None
+    label_snapshot = None
+
+    # image filename -> label indices which couldn't be calculated last time
+    retry = None
+
+    # increases every time heatmap_data changes. Rendered data is cached until
+    # the version changes.
+    version = 0
+    cache = None
+    cache_version = None
+
+    def __init__(self, coords_csv, image_dir, labels, mode):
+        self.coords_csv = coords_csv
+        self.image_dir = image_dir
+        self.labels = labels
+        self.mode = mode
+        self.composite_label = len(labels) - 1
+
+        self.heatmap_data = np.zeros((3, len(labels) + 1, NERVE_COORD * 2, NERVE_COORD * 2), dtype=np.uint16)
+        self.records = dict()
+        self.contributions = dict()
+        self.label_snapshot = dict()
+        self.retry = dict()
+        self.cache = dict()
+        self.lock = threading.Lock()
+
+    # Load the coordinates CSV file. If an image appears more than once, the
+    # last entry is used. Blank rows are skipped, and malformed rows are
+    # reported and skipped. An unfinished last line (still being written) is
+    # skipped silently - it will be read once it changes.
+    # Returns None if the file can't be read.
+    def readRecords(self):
+        try:
+            with open(self.coords_csv) as csvfile:
+                text = csvfile.read()
+        except OSError as e:
+            print("ERROR: can't read coordinates_csv file \"" + self.coords_csv + "\":", e)
+            return None
+
+        lines = text.splitlines()
+        records = dict()
+        for index, row in enumerate(csv.reader(lines, delimiter=',')):
+            # ignore the first row - header
+            if (index == 0 or not row or not "".join(row).strip()):
+                continue
+
+            try:
+                record = parseCoordsRow(row, self.image_dir)
+            except (ValueError, IndexError) as e:
+                if index == len(lines) - 1 and not text.endswith("\n"):
+                    continue
+                print("ERROR: malformed row " + str(index + 1) + " in \"" + self.coords_csv + "\" (ignoring):", e)
+                continue
+
+            records[record.filename] = record
+
+        return records
+
+    def readCoordsSnapshot(self):
+        try:
+            stat = os.stat(self.coords_csv)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    # Modification time of every file in each label directory.
+    def readLabelSnapshot(self):
+        snapshot = dict()
+        for index, lesion in enumerate(self.labels):
+            if index == self.composite_label:
+                continue
+
+            snapshot[index] = dict()
+            label_dir = os.path.join(self.image_dir, LESION_SUBDIR, lesion)
+            if not os.path.isdir(label_dir):
+                continue
+
+            with os.scandir(label_dir) as entries:
+                for entry in entries:
+                    try:
+                        snapshot[index][entry.name] = entry.stat().st_mtime_ns
+                    except OSError:
+                        continue
+
+        return snapshot
+
+    # Calculate the contribution of one image to the heatmap, for the given
+    # label indices. Returns { label index: (side, marks) }, and
+    # { label index: label file } for the label files which couldn't be read
+    # (e.g. they are being written to).
+    def calculateContributions(self, record, indices):
+        contributions = dict()
+        failed = dict()
+
+        if not os.path.exists(record.filename):
+            print("ERROR: image does not exist (ignoring): " + record.filename)
+            return contributions, failed
+
+        side = rightOrLeft(record)
+        nerve_xy_scaled, scaling_factor, rotation = scaleImage(record)
+        if (nerve_xy_scaled == None or scaling_factor == None):
+            print("ERROR: ignoring file: " + record.filename)
+            return contributions, failed
+
+        canvas_shape = self.heatmap_data.shape[-2:]
+        for index in indices:
+            lesion = list(self.labels)[index]
+            lesion_image_path = findLabelFile(self.image_dir, lesion, record.filename)
+            if lesion_image_path is None:
+                continue
+
+            lesion_orig = loadLabel(lesion_image_path)
+            if lesion_orig is None:
+                failed[index] = lesion_image_path
+                continue
+
+            try:
+                if self.mode == INSTANCE_MODE:
+                    centroids, areas = labelInstances(lesion_orig)
+                    marks, outside = labelInstanceMarks(centroids, areas, nerve_xy_scaled,
+                                                        scaling_factor, rotation, canvas_shape)
+                    if outside > 0:
+                        print("ERROR:", outside, lesion, "lesion(s) mapping outside of bounds (ignoring):", os.path.basename(record.filename))
+                else:
+                    lesion_scaled = warpLabel(lesion_orig, nerve_xy_scaled, scaling_factor, rotation)
+                    marks = labelPixelMarks(lesion_scaled, nerve_xy_scaled, canvas_shape)
+                    if marks is None:
+                        print("ERROR:", lesion, "mapping outside of bounds (ignoring):", os.path.basename(record.filename))
+                        continue
+            except Exception as e:
+                # this won't fix itself, so leave it out until the label changes
+                print("ERROR: failed to process label file (ignoring until it changes): " + lesion_image_path + ":", e)
+                continue
+
+            contributions[index] = (side, marks)
+
+        return contributions, failed
+
+    # Put back the old snapshot entries for an image's label files, so they
+    # are seen as changed (and retried) next time.
+    def keepOldLabelSnapshot(self, label_snapshot, filename, indices):
+        stem = imageStem(filename)
+        for index in indices:
+            old = self.label_snapshot.get(index, dict())
+            new = label_snapshot[index]
+            for name in [n for n in set(old) | set(new) if labelStem(n) == stem]:
+                if name in old:
+                    new[name] = old[name]
+                else:
+                    new.pop(name, None)
+
+    # Replace the stored contributions of an image. Call with the lock held.
+    def applyContributions(self, filename, contributions):
+        old = self.contributions.setdefault(filename, dict())
+        for index, (side, marks) in contributions.items():
+            if index in old:
+                old_side, old_marks = old.pop(index)
+                addMarks(self.heatmap_data, old_side, index, self.composite_label, old_marks, remove=True)
+
+            if marks is not None:
+                addMarks(self.heatmap_data, side, index, self.composite_label, marks)
+                old[index] = (side, marks)
+
+        if not old:
+            del self.contributions[filename]
+
+    # Check the coordinates CSV file and label directories, and update the
+    # heatmap data for any images that have changed.
+    # Returns the number of images updated.
+    def update(self):
+        label_indices = [i for i in range(len(self.labels)) if i != self.composite_label]
+
+        # image filename -> label indices to recalculate
+        changed = dict()
+
+        coords_snapshot = self.readCoordsSnapshot()
+        records = self.records
+        if coords_snapshot != self.coords_snapshot:
+            records = self.readRecords()
+            if records is None:
+                # can't be read - keep the old data until the file changes
+                records = self.records
+            else:
+                for filename in set(self.records) | set(records):
+                    old = self.records.get(filename)
+                    new = records.get(filename)
+                    if (old is None or new is None or
+                            old.nerve_xy != new.nerve_xy or old.mac_xy != new.mac_xy):
+                        changed[filename] = set(label_indices)
+
+        label_snapshot = self.readLabelSnapshot()
+        stems = dict()
+        for index in label_indices:
+            old = self.label_snapshot.get(index, dict())
+            new = label_snapshot[index]
+            for name in set(old) | set(new):
+                if old.get(name) != new.get(name):
+                    stems.setdefault(labelStem(name), set()).add(index)
+
+        if stems:
+            for filename in records:
+                indices = stems.get(imageStem(filename))
+                if indices:
+                    changed.setdefault(filename, set()).update(indices)
+
+        # and anything that failed last time
+        old_retry = self.retry
+        for filename, indices in old_retry.items():
+            changed.setdefault(filename, set()).update(indices)
+        self.retry = dict()
+
+        if not changed:
+            self.coords_snapshot = coords_snapshot
+            self.label_snapshot = label_snapshot
+            return 0
+
+        # do the slow part (loading and transforming labels) without the lock
+        updates = dict()
+        for filename, indices in changed.items():
+            failed = dict()
+            if filename in records:
+                try:
+                    updates[filename], failed = self.calculateContributions(records[filename], sorted(indices))
+                except Exception as e:
+                    # Don't let one bad image stop the others updating. This
+                    # won't fix itself (e.g. invalid tagging), so leave the image
+                    # out until its coordinates or labels change.
+                    print("ERROR: failed to update " + os.path.basename(filename) + " (ignoring until it changes):", e)
+                    updates[filename] = dict()
+                    failed = dict()
+            else:
+                updates[filename] = dict()
+
+            # keep the old data for label files we couldn't read if they are
+            # probably being written to, and try again next time
+            retry = set()
+            for index, lesion_image_path in failed.items():
+                try:
+                    age = time.time() - os.path.getmtime(lesion_image_path)
+                except OSError:
+                    age = 0.0
+
+                if age < LABEL_RETRY_TIME:
+                    if index not in old_retry.get(filename, set()):
+                        print("ERROR: label file can't be read (will retry): " + lesion_image_path)
+                    retry.add(index)
+                else:
+                    print("ERROR: label file can't be read (ignoring until it changes): " + lesion_image_path)
+
+            if retry:
+                self.retry[filename] = retry
+                self.keepOldLabelSnapshot(label_snapshot, filename, retry)
+
+            # anything else we couldn't calculate (or was removed) is taken out
+            for index in indices - retry:
+                updates[filename].setdefault(index, (None, None))
+
+            if not updates[filename]:
+                del updates[filename]
+
+        with self.lock:
+            for filename, contributions in updates.items():
+                self.applyContributions(filename, contributions)
+            self.records = records
+            self.coords_snapshot = coords_snapshot
+            self.label_snapshot = label_snapshot
+            if updates:
+                self.version += 1
+
+        return len(updates)
+
+    # Get a cached rendering (or render it). Call with the lock held.
+    def cached(self, key, render):
+        if self.cache_version != self.version:
+            self.cache = dict()
+            self.cache_version = self.version
+
+        if key not in self.cache:
+            self.cache[key] = render()
+
+        return self.cache[key]
+
+    # Trimmed lesion counts for one side and label, as CSV text.
+    def countsCsv(self, side, index):
+        def render():
+            trimmed = trimImageArrays(self.heatmap_data[:, [index]], [index])
+            f = io.StringIO()
+            np.savetxt(f, trimmed[side][0], fmt="%i", delimiter=",")
+            return f.getvalue().encode()
+
+        with self.lock:
+            return self.cached(("csv", side, index), render)
+
+    # Rendered heatmap for one label (right, left and combined), as PNG data.
+    def heatmapPng(self, index):
+        def render():
+            stack = renderHeatmapStack(self.heatmap_data, index, list(self.labels.values())[index])
+            return cv2.imencode(".png", stack)[1].tobytes()
+
+        with self.lock:
+            return self.cached(("png", index), render)
+
+    def status(self):
+        with self.lock:
+            return { "images": len(self.contributions),
+                     "version": self.version,
+                     "mode": self.mode,
+                     "labels": list(self.labels) }
+
+def watch(state):
+    while True:
+        time.sleep(POLL_INTERVAL)
+        try:
+            updated = state.update()
+        except Exception as e:
+            print("ERROR: failed to update heatmaps:", e)
+            continue
+
+        if updated > 0:
+            print("Updated", updated, "image(s)")
+
+class HeatmapRequestHandler(http.server.BaseHTTPRequestHandler):
+    state = None
+
+    def send(self, content_type, body, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendError(self, status, message):
+        self.send("text/plain; charset=utf-8", (message + "\n").encode(), status)
+
+    def labelIndex(self, label):
+        if label not in self.state.labels:
+            return None
+        return list(self.state.labels).index(label)
+
+    # Available URLs:
+    #   /                           list of heatmaps
+    #   /status                     summary of the loaded data (JSON)
+    #   /heatmap/<label>.png        heatmap for each side
+    #   /counts/<side>/<label>.csv  lesion counts, as in create_heatmap.py
+    def do_GET(self):
+        parts = [p for p in urllib.parse.urlparse(self.path).path.split("/") if p]
+
+        if not parts:
+            lines = ["<html><body><h1>Heatmaps</h1><ul>"]
+            for label, name in self.state.labels.items():
+                lines.append("<li><a href=\"/heatmap/" + label + ".png\">" + name + "</a> (counts: " +
+                             ", ".join("<a href=\"/counts/" + s + "/" + label + ".csv\">" + s + "</a>" for s in SIDE_LABELS.values()) +
+                             ")</li>")
+            lines.append("</ul></body></html>")
+            self.send("text/html; charset=utf-8", "\n".join(lines).encode())
+        elif parts == ["status"]:
+            self.send("application/json", json.dumps(self.state.status()).encode())
+        elif len(parts) == 2 and parts[0] == "heatmap" and parts[1].endswith(".png"):
+            index = self.labelIndex(parts[1][:-len(".png")])
+            if index is None:
+                self.sendError(404, "unknown label: " + parts[1])
+                return
+            self.send("image/png", self.state.heatmapPng(index))
+        elif len(parts) == 3 and parts[0] == "counts" and parts[2].endswith(".csv"):
+            sides = { name: side for side, name in SIDE_LABELS.items() }
+            index = self.labelIndex(parts[2][:-len(".csv")])
+            if parts[1] not in sides or index is None:
+                self.sendError(404, "unknown side or label: " + parts[1] + "/" + parts[2])
+                return
+            self.send("text/csv", self.state.countsCsv(sides[parts[1]], index))
+        else:
+            self.sendError(404, "not found: " + self.path)
+
+if __name__ == '__main__':
+    mode = popOption(sys.argv, "--mode", PIXEL_MODE)
+    port = popOption(sys.argv, "--port", str(DEFAULT_PORT))
+
+    if len(sys.argv) != 4:
+        printUsage()
+        sys.exit(1)
+
+    cli_args_valid = True
+
+    if mode not in MODES:
+        print("ERROR: mode must be 'pixels' or 'instances'")
+        cli_args_valid = False
+
+    if port is None or not port.isdigit():
+        print("ERROR: port must be a number")
+        cli_args_valid = False
+
+    coords_csv = os.path.abspath(sys.argv[1])
+    if not os.path.exists(coords_csv):
+        print("ERROR: coordinates_csv file \"" + coords_csv + "\" does not exist")
+        cli_args_valid = False
+
+    image_dir = os.path.abspath(sys.argv[2])
+    if not os.path.exists(image_dir):
+        print("ERROR: image_dir path \"" + image_dir + "\" does not exist")
+        cli_args_valid = False
+
+    data_type = sys.argv[3]
+    labels = LESION_LABELS
+    if data_type == "vessels":
+        labels = VESSEL_LABELS
+    elif data_type != "dr":
+        print("ERROR: data_type must be 'dr' or 'vessels'")
+        cli_args_valid = False
+
+    if not cli_args_valid:
+        printUsage()
+        sys.exit(1)
+
+    print("Using CSV file \"" + coords_csv + "\"")
+    print("with image dir \"" + image_dir + "\"")
+    print("counting lesion " + mode)
+
+    state = HeatmapState(coords_csv, image_dir, labels, mode)
+
+    print("Extracting lesion data...", end='', flush=True)
+    state.update()
+    print("done (" + str(len(state.contributions)) + " images)")
+
+    threading.Thread(target=watch, args=(state,), daemon=True).start()
+
+    HeatmapRequestHandler.state = state
+    server = http.server.ThreadingHTTPServer(("localhost", int(port)), HeatmapRequestHandler)
+    print("Serving heatmaps at http://localhost:" + port + "/")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    server.server_close()
+
+# EOF